@@ -4,19 +4,26 @@ Flask server that accepts video files, applies watermarks, and returns the proce
 
 import os
 import io
+import shutil
+import traceback
 import torch
-import ffmpeg
 import numpy as np
 import uuid
-import subprocess
+import heapq
+import av
 from flask import Flask, request, Response, jsonify
 from requests_toolbelt import MultipartEncoder
 import json
+from concurrent.futures import ThreadPoolExecutor
 from torchcodec.decoders import VideoDecoder
 from torchaudio.io import StreamWriter
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 torch.set_grad_enabled(False)
+# Input sizes repeat from chunk to chunk, let cuDNN pick the fastest algorithms for them
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 import videoseal
 from videoseal.utils.display import save_video_audio_to_mp4
@@ -24,27 +31,82 @@ from videoseal.utils.display import save_video_audio_to_mp4
 # Initialize Flask app
 app = Flask(__name__)
 
+# Requests are served on Flask's threads, so uploads and responses of different requests
+# overlap, but all GPU work goes through this single worker to run one video at a time.
+gpu_executor = ThreadPoolExecutor(max_workers=1)
+# Temporary files are removed in the background, off the request threads
+cleanup_executor = ThreadPoolExecutor(max_workers=2)
+
 # Initialize models
 video_model = videoseal.load("videoseal")
 video_model.eval()
 video_model.to(device)
 
-
+# Run the networks in reduced precision on tensor cores, bfloat16 needs Ampere or newer.
+# The weights stay in float32 and autocast only lowers convs and matmuls, so the
+# full resolution blending of the watermark with the frames keeps float32 precision.
+autocast_dtype = torch.bfloat16 if device.type == "cpu" or torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+video_model.embedder.to(memory_format=torch.channels_last)
+
+# Compile the networks used by embed and detect, the surrounding chunking logic stays eager.
+# CUDA graphs are not used since the model runs on a side stream.
+# Triton builds its launcher with a C compiler, looked up as below, which the CUDA runtime
+# image does not ship: without one the networks run eagerly. The compiled networks are only
+# swapped in by the warm-up, which keeps the eager ones if compiling them fails.
+eager_networks = (video_model.embedder, video_model.detector)
+compiled_networks = None
+if os.environ.get("CC") or shutil.which("gcc") or shutil.which("clang"):
+    # the batch size changes with the chunk size and at the end of each video
+    compiled_networks = (torch.compile(video_model.embedder, dynamic=True), torch.compile(video_model.detector, dynamic=True))
+
+# Rough device footprint per frame element of a chunk: decoded uint8 frames, float32 input,
+# watermark deltas, blended output and uint8 result, for the two chunks in flight.
+CHUNK_BYTES_PER_ELEMENT = 32
+MIN_CHUNK_SIZE = 8
+MAX_CHUNK_SIZE = 64
+
+# Read once at startup, so a bad value stops the server instead of failing every request
+CHUNK_SIZE_OVERRIDE = os.environ.get("VIDEOSEAL_CHUNK")
+if CHUNK_SIZE_OVERRIDE is not None:
+    if not CHUNK_SIZE_OVERRIDE.strip().isdigit() or int(CHUNK_SIZE_OVERRIDE) == 0:
+        raise ValueError(f"VIDEOSEAL_CHUNK must be a positive number of frames, got {CHUNK_SIZE_OVERRIDE!r}")
+    # not clamped, only rounded down to a multiple of the model's step size
+    CHUNK_SIZE_OVERRIDE = max(int(CHUNK_SIZE_OVERRIDE) // video_model.step_size, 1) * video_model.step_size
+
+def get_chunk_size(width, height):
+    """Number of frames per chunk, as large as fits in 30% of the free VRAM unless set with VIDEOSEAL_CHUNK.
+    The computed value is clamped to [MIN_CHUNK_SIZE, MAX_CHUNK_SIZE] and rounded down to a multiple of the model's step size."""
+    if CHUNK_SIZE_OVERRIDE is not None:
+        return CHUNK_SIZE_OVERRIDE
+    free_bytes, _ = torch.cuda.mem_get_info(device)
+    # memory cached by PyTorch but not in use is available to this process as well
+    free_bytes += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    chunk_size = int(free_bytes * 0.3 / (3 * height * width * CHUNK_BYTES_PER_ELEMENT))
+    chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    # keep chunk boundaries aligned with the frames the model propagates the watermark from
+    return chunk_size // video_model.step_size * video_model.step_size
+
+def to_uint8(imgs):
+    """Scale images in [0, 1] to uint8, in place so no float temporary is allocated."""
+    return imgs.mul_(255.0).to(torch.uint8)
+
+@torch.inference_mode()
 def process_video_chunk(chunk, message_bits=None):
     """Process a video chunk by applying watermarks."""
 
-    clip_tensor = chunk.data.float() / 255.0
-    size_bytes = clip_tensor.element_size() * clip_tensor.nelement()
-    outputs = video_model.embed(clip_tensor, msgs=message_bits, is_video=True)
-    processed_clip = outputs["imgs_w"]
-    processed_clip = (processed_clip * 255.0).byte()
+    # uint8 -> [0, 1] in one pass
+    clip_tensor = chunk.data / 255.0
+    with torch.autocast(device_type=device.type, dtype=autocast_dtype):
+        outputs = video_model.embed(clip_tensor, msgs=message_bits, is_video=True)
+    processed_clip = to_uint8(outputs["imgs_w"])
     return processed_clip
 
-def embed_video(input_path, output_path, chunk_size=8):
+def embed_video(input_path, output_path, chunk_size=None):
     """Process a video using streaming to handle memory efficiently."""
-    # Generate random message bits to use for all chunks
-    message_bits = torch.randint(0, 2, (1, 96), device=device)
-    message_bits_list = message_bits.cpu().numpy().flatten().tolist()
+    # Generate random message bits to use for all chunks, on the host since they are also returned
+    message_bits_host = np.random.randint(0, 2, size=(1, 96), dtype=np.int64)
+    message_bits = torch.from_numpy(message_bits_host).to(device, non_blocking=True)
+    message_bits_list = message_bits_host.flatten().tolist()
 
 
     decoder = VideoDecoder(input_path, device='cuda', dimension_order='NCHW')
@@ -52,52 +114,124 @@ def embed_video(input_path, output_path, chunk_size=8):
     height = decoder.metadata.height
     frame_rate = decoder.metadata.average_fps
     num_frames = decoder.metadata.num_frames
+    if chunk_size is None:
+        chunk_size = get_chunk_size(width, height)
+
+    # Encode the video alone next to the output, the audio is muxed in afterwards
+    video_path = f"{output_path}.video.mp4"
+    stream = create_video_writer(video_path, frame_rate, width, height)
+    # The model runs on a side stream: while chunk i is being watermarked, the host
+    # encodes chunk i-1 and decodes chunk i+1, keeping NVDEC, the SMs and NVENC busy.
+    compute_stream = torch.cuda.Stream()
+    pending = None  # (processed frames, completion event) of the previous chunk
+    try:
+        with stream.open():
+            for i in range(0, len(decoder), chunk_size):
+                frames = decoder[i : i + chunk_size]
+                compute_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(compute_stream):
+                    # the decoded frames are freed on the decode stream, keep them alive for this one
+                    frames.record_stream(compute_stream)
+                    processed_frames = process_video_chunk(frames, message_bits)
+                    done = torch.cuda.Event()
+                    done.record()
+
+                if pending is not None:
+                    write_processed_chunk(stream, *pending)
+                pending = (processed_frames, done)
+
+            if pending is not None:
+                write_processed_chunk(stream, *pending)
+
+        mux_audio(video_path, input_path, output_path)
+    finally:
+        # off the GPU worker, so the next queued video does not wait on the unlink
+        cleanup_executor.submit(remove_files, [video_path])
+    return output_path, message_bits_list
 
-    stream = StreamWriter(output_path, format="mp4")
+def create_video_writer(dst, frame_rate, width, height):
+    """Create the NVENC writer, encoding CUDA frames to h264."""
+    stream = StreamWriter(dst, format="mp4")
     stream.add_video_stream(frame_rate=frame_rate, width=width, height=height, hw_accel="cuda:0", encoder="h264_nvenc", encoder_format="rgb0")
-    with stream.open():
-        for i in range(0, len(decoder), chunk_size):
-            frames = decoder[i : i + chunk_size]
-            processed_frames = process_video_chunk(frames, message_bits.clone())
-            stream.write_video_chunk(0, processed_frames)
+    return stream
 
-    return output_path, message_bits_list
+def write_processed_chunk(stream, processed_frames, done):
+    """Encode a chunk once the side stream has finished producing it."""
+    # the encoder copies the frames outside of torch's streams, so wait on the host
+    done.synchronize()
+    stream.write_video_chunk(0, processed_frames)
 
+def mux_audio(video_source, audio_source, output_path):
+    """Copy the video of video_source and the audio of audio_source into output_path, without re-encoding."""
+    try:
+        copy_streams(video_source, audio_source, output_path, with_audio=True)
+    except av.FFmpegError:
+        # e.g. an audio codec that mp4 cannot hold, return the watermarked video alone
+        copy_streams(video_source, audio_source, output_path, with_audio=False)
+
+def copy_streams(video_source, audio_source, output_path, with_audio):
+    """Write the video stream of video_source, and optionally the audio stream of audio_source, to output_path."""
+    with av.open(video_source, format="mp4") as video_in, av.open(audio_source) as audio_in, \
+            av.open(output_path, "w", format="mp4") as output:
+        video_stream = video_in.streams.video[0]
+        packets = [demux_into(video_in, video_stream, output.add_stream_from_template(video_stream, opaque=True))]
+        # the upload may have no audio track, in which case only the video is written
+        if with_audio and audio_in.streams.audio:
+            audio_stream = audio_in.streams.audio[0]
+            packets.append(demux_into(audio_in, audio_stream, output.add_stream_from_template(audio_stream, opaque=True)))
+
+        # interleave both inputs by decoding time, so the muxer does not have to buffer one of them
+        for packet in heapq.merge(*packets, key=lambda packet: packet.dts * packet.time_base):
+            output.mux(packet)
+
+def demux_into(container, in_stream, out_stream):
+    """Yield the packets of in_stream, retargeted to out_stream."""
+    for packet in container.demux(in_stream):
+        # skip the empty packets used to flush the demuxer
+        if packet.dts is None:
+            continue
+        packet.stream = out_stream
+        yield packet
+
+@torch.inference_mode()
 def analyze_video_chunk(chunk):
     """Analyze a video chunk to extract watermark bits."""
     # Convert chunk to tensor and normalize to [0, 1]
-    clip_tensor = chunk.data.float() / 255.0
+    clip_tensor = chunk.data / 255.0
 
     # Extract watermark bits
-    outputs = video_model.detect(clip_tensor, is_video=True)
-    output_bits = outputs["preds"][:, 1:]  # exclude the first which may be used for detection
+    with torch.autocast(device_type=device.type, dtype=autocast_dtype):
+        outputs = video_model.detect(clip_tensor, is_video=True)
+    output_bits = outputs["preds"][:, 1:].float()  # exclude the first which may be used for detection
     
     return output_bits
 
-def analyze_video(input_path, chunk_size=8):
+def analyze_video(input_path, chunk_size=None):
     """Process a video using streaming to extract watermark bits."""
-    # Get video info
-    probe = ffmpeg.probe(input_path)
-    video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-    width = int(video_info['width'])
-    height = int(video_info['height'])
-    num_frames = int(video_info['nb_frames'])
-
     decoder = VideoDecoder(input_path, device='cuda', dimension_order='NCHW')
-    soft_msgs = []
+    if chunk_size is None:
+        chunk_size = get_chunk_size(decoder.metadata.width, decoder.metadata.height)
+    # Running sum of the per-frame predictions of the 96 bits, kept on device in float64
+    msg_sum = torch.zeros(96, dtype=torch.float64, device=device)
     for i in range(0, len(decoder), chunk_size):
         frames = decoder[i : i + chunk_size]
         output_bits = analyze_video_chunk(frames)
-        soft_msgs.append(output_bits)
-
+        msg_sum += output_bits.sum(dim=0, dtype=torch.float64)
 
-    all_msgs = torch.cat(soft_msgs, dim=0)
     # Average across frames to get final bit predictions
-    avg_msg = all_msgs.mean(dim=0)
+    avg_msg = msg_sum / len(decoder)
     # Convert to binary predictions
     final_bits = avg_msg.cpu().numpy().tolist()
     return final_bits
 
+def remove_files(paths):
+    """Remove temporary files, skipping the ones that were never created."""
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
 @app.route('/process_video', methods=['POST'])
 def process_video_file():
     """Handle video upload and processing."""
@@ -111,53 +245,36 @@ def process_video_file():
     # Create temporary files for input and output
     temp_input = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"temp_input_{uuid.uuid4()}.mp4")
     temp_output = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"temp_output_{uuid.uuid4()}.mp4")
-    temp_output2 = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"temp_output2_{uuid.uuid4()}.mp4")
     
     try:
         # Save uploaded file
-        video_file.save(temp_input)
+        video_file.save(temp_input, buffer_size=1 << 20)
         
-        # Process video using streaming
-        _, message_bits = embed_video(temp_input, temp_output)
-        audiostream = ffmpeg.input(temp_input)
-        videostream = ffmpeg.input(temp_output)
-        process3 = (
-            ffmpeg
-            .output(
-                videostream.video,
-                audiostream.audio,
-                temp_output2,
-                vcodec='copy',
-                acodec='copy'
-            )
-            .overwrite_output()
-            .run_async(pipe_stderr=subprocess.PIPE)
-        )
-        combine_result = process3.wait()
+        # Process video using streaming, the audio of the upload is muxed into the output
+        _, message_bits = gpu_executor.submit(embed_video, temp_input, temp_output).result()
 
-        
+        video = open(temp_output, 'rb')
         m = MultipartEncoder(fields={
-            'video': open(temp_output2 if combine_result == 0 else temp_output, 'rb'),
+            'video': video,
             'message_bits': json.dumps(message_bits)
         })
 
         def generate():
-            # Read in chunks (adjust chunk size as needed)
-            chunk_size = 4096
-            for chunk in iter(lambda: m.read(chunk_size), b''):
+            # Read in 1 MiB chunks, few large reads and writes for the whole video
+            chunk_size = 1 << 20
+            try:
+                for chunk in iter(lambda: m.read(chunk_size), b''):
                     yield chunk
+            finally:
+                # close the output as soon as it is sent, or if the client disconnects
+                video.close()
 
 
         return Response(generate(), mimetype=m.content_type)
 
     finally:
         # Clean up temporary files
-        for path in [temp_input, temp_output, temp_output2]:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
+        cleanup_executor.submit(remove_files, [temp_input, temp_output])
 
 @app.route('/analyze_video', methods=['POST'])
 def analyze_video_file():
@@ -174,10 +291,10 @@ def analyze_video_file():
     
     try:
         # Save uploaded file
-        video_file.save(temp_input)
+        video_file.save(temp_input, buffer_size=1 << 20)
         
         # Extract watermark bits
-        extracted_bits = analyze_video(temp_input)
+        extracted_bits = gpu_executor.submit(analyze_video, temp_input).result()
         
         return jsonify({
             'extracted_bits': extracted_bits
@@ -188,8 +305,54 @@ def analyze_video_file():
     
     finally:
         # Clean up temporary files
-        if os.path.exists(temp_input):
-            os.remove(temp_input)
+        cleanup_executor.submit(remove_files, [temp_input])
+
+def warm_up():
+    """Initialize CUDA, NVENC, the compiled networks and cuDNN's algorithms before the first request."""
+    if compiled_networks is not None:
+        video_model.embedder, video_model.detector = compiled_networks
+        try:
+            run_warm_up_passes()
+            return
+        except Exception:
+            # finding a C compiler does not mean compiling works, e.g. without the Python
+            # headers or a libcuda to link against: serve with the eager networks instead
+            print("Compiling the networks failed, running them eagerly:")
+            traceback.print_exc()
+            video_model.embedder, video_model.detector = eager_networks
+    run_warm_up_passes()
+
+def run_warm_up_passes():
+    """Embed, encode and detect on blank frames."""
+    # The networks always see frames resized to the model's 256x256, so only their batch size
+    # varies: embed runs the embedder on one keyframe every step_size frames, and detect runs
+    # the detector on at most chunk_size frames at a time. Go through each batch size they can
+    # get from a chunk, down to the shorter last chunks, so each is compiled and benchmarked once.
+    largest_chunk = CHUNK_SIZE_OVERRIDE or MAX_CHUNK_SIZE
+    step_size = video_model.step_size
+    max_keyframes = min(largest_chunk // step_size, video_model.chunk_size)
+    max_detected = min(largest_chunk, video_model.chunk_size)
+    frames = torch.zeros((max(max_keyframes * step_size, max_detected), 3, 256, 256), dtype=torch.uint8, device=device)
+    message_bits = torch.zeros((1, 96), dtype=torch.int64, device=device)
+    for num_keyframes in range(1, max_keyframes + 1):
+        processed_frames = process_video_chunk(frames[:num_keyframes * step_size], message_bits)
+    for num_frames in range(1, max_detected + 1):
+        analyze_video_chunk(frames[:num_frames])
+
+    stream = create_video_writer(io.BytesIO(), 30, 256, 256)
+    # fragmented mp4 can be written to a non seekable buffer
+    with stream.open(option={"movflags": "frag_keyframe+empty_moov"}):
+        stream.write_video_chunk(0, processed_frames)
+
+def report_warm_up(future):
+    """Print the error of a failed warm-up, which would otherwise be dropped with its future."""
+    error = future.exception()
+    if error is not None:
+        print("GPU warm-up failed:")
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+# Queued first, so requests wait for it instead of paying the initialization themselves
+gpu_executor.submit(warm_up).add_done_callback(report_warm_up)
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8001)
\ No newline at end of file
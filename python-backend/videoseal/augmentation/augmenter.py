@@ -11,6 +11,7 @@ Test with:
 
 import os
 
+import numpy as np
 import torch
 from torch import nn
 
@@ -83,6 +84,12 @@ class Augmenter(nn.Module):
             augs=augs,
             augs_params=augs_params
         )
+        # cumulative probabilities, to sample an augmentation on the host without torch.multinomial
+        self.aug_cdf = np.cumsum(self.aug_probs.numpy())
+        self.aug_cdf[-1] = 1.0  # guard against rounding errors
+        # same augs for images, with video compression replaced by identity
+        identity = Identity()
+        self.image_augs = [aug if aug.__class__.__name__ != 'VideoCompressorAugmenter' else identity for aug in self.augs]
         self.num_augs = num_augs
 
     def parse_augmentations(
@@ -118,11 +125,8 @@ class Augmenter(nn.Module):
         return augmentations, torch.tensor(probs)
 
     def augment(self, image, mask=None, is_video=False, do_resize=True):
-        if not is_video:  # replace video compression with identity
-            augs = [aug if aug.__class__.__name__ != 'VideoCompressorAugmenter' else Identity() for aug in self.augs]
-        else:
-            augs = self.augs
-        index = torch.multinomial(self.aug_probs, 1).item()
+        augs = self.augs if is_video else self.image_augs
+        index = int(np.searchsorted(self.aug_cdf, np.random.random(), side='right'))
         selected_aug = augs[index]
         if not do_resize:
             image, mask = selected_aug(image, mask)
@@ -169,12 +173,16 @@ class Augmenter(nn.Module):
         else:
             # no mask
             mask_targets = torch.ones_like(imgs_w)[:, 0:1, :, :]
+            imgs_aug = imgs_w
             # image augmentations
+            if self.num_augs == 1:
+                return self.augment(imgs_aug, mask_targets, is_video, do_resize=False)
             selected_augs = []
             for _ in range(self.num_augs):
                 imgs_aug, mask_targets, selected_aug_ = self.augment(
                     imgs_aug, mask_targets, is_video, do_resize=False)
                 selected_augs.append(selected_aug_)
+            selected_aug = "+".join(selected_augs)
             return imgs_aug, mask_targets, selected_aug
 
     def __repr__(self) -> str: